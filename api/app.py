@@ -1,25 +1,54 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, g
 from flask_cors import CORS
 import logging
 from logging.handlers import RotatingFileHandler
 import psycopg2
 from psycopg2 import pool
 import os
+import sys
+import glob
+import hmac
 import random
+import secrets
 import string
 from datetime import datetime, timedelta
+from collections import OrderedDict, Counter
+from functools import wraps
+import threading
 import json
+import time
+import click
 
 # Configuration
 TOKEN = os.environ.get("TOKEN")
 WEB_APP_URL = os.environ.get("WEB_APP_URL", "https://your-github-username.github.io/zebi-bingo-web")
 ADMIN_IDS = [int(x) for x in os.environ.get("ADMIN_IDS", "").split(',') if x]
 DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_SIZE = 10
 INITIAL_WALLET = 10
 BET_OPTIONS = [10, 50, 100, 200]
 HOUSE_CUT = 0.02
 MINIMUM_WITHDRAWAL = 100
 MINIMUM_DEPOSIT = 50
+IDEMPOTENCY_TTL = timedelta(hours=24)
+IDEMPOTENCY_CACHE_SIZE = 1024
+IDEMPOTENCY_CLAIM_TIMEOUT = timedelta(seconds=30)
+REFERRAL_BONUS_THRESHOLD = 20
+REFERRAL_BONUS_AMOUNT = 10
+REFERRAL_BONUS_BATCH_SIZE = 500
+STATS_GRANULARITIES = ['hour', 'day']
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/zebi-bingo-profiles")
+PROFILE_INTERVAL = 0.005
+PROFILE_SWITCH_INTERVAL = 0.001
+PROFILE_RETENTION = 50
+PAYMENT_PROVIDER = os.environ.get("PAYMENT_PROVIDER")
+DEPOSIT_BATCH_SIZE = 50
+DEPOSIT_CLAIM_TIMEOUT = timedelta(minutes=5)
+DEPOSIT_RETRY_BASE = timedelta(seconds=30)
+DEPOSIT_RETRY_MAX = timedelta(minutes=30)
+DEPOSIT_VERIFY_WINDOW = timedelta(hours=24)
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -32,14 +61,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger('api')
 
-# Database connection pool
+# Database connection pool, shared by request and worker threads
 db_pool = None
+db_pool_lock = threading.Lock()
 
-def get_db_connection():
+def get_db_pool():
     global db_pool
-    if db_pool is None:
-        db_pool = psycopg2.pool.SimpleConnectionPool(1, 10, DATABASE_URL)
-    return db_pool.getconn()
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = psycopg2.pool.ThreadedConnectionPool(1, DB_POOL_SIZE, DATABASE_URL)
+    return db_pool
+
+def get_db_connection():
+    return get_db_pool().getconn()
 
 def release_db_connection(conn):
     if db_pool is not None:
@@ -65,6 +99,12 @@ def init_db():
                 )
             ''', (INITIAL_WALLET,))
             
+            cursor.execute('''
+                ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS referral_bonuses_paid INTEGER DEFAULT 0
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS games (
                     game_id TEXT PRIMARY KEY,
@@ -89,6 +129,27 @@ def init_db():
                 )
             ''')
             
+            cursor.execute('''
+                ALTER TABLE player_cards
+                ADD COLUMN IF NOT EXISTS finished BOOLEAN DEFAULT FALSE
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_player_cards_game_user
+                ON player_cards (game_id, user_id)
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id BIGINT PRIMARY KEY,
+                    games_played INTEGER DEFAULT 0,
+                    wins INTEGER DEFAULT 0,
+                    total_wagered BIGINT DEFAULT 0,
+                    total_won BIGINT DEFAULT 0,
+                    invalid_bingo_count INTEGER DEFAULT 0
+                )
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS transactions (
                     tx_id TEXT PRIMARY KEY,
@@ -101,6 +162,23 @@ def init_db():
                 )
             ''')
             
+            cursor.execute('''
+                ALTER TABLE transactions
+                ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS verify_attempts INTEGER DEFAULT 0
+            ''')
+            
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_verification_code
+                ON transactions (method, verification_code)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_transactions_next_attempt
+                ON transactions (next_attempt_at)
+                WHERE status IN ('pending', 'verifying')
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS withdrawals (
                     withdraw_id TEXT PRIMARY KEY,
@@ -113,6 +191,104 @@ def init_db():
                 )
             ''')
             
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referrals (
+                    referred_id BIGINT PRIMARY KEY,
+                    referrer_id BIGINT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_referrals_referrer_id
+                ON referrals (referrer_id)
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS idempotency_keys (
+                    idem_key TEXT,
+                    endpoint TEXT,
+                    user_id BIGINT,
+                    status_code SMALLINT,
+                    response TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, endpoint, idem_key)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at
+                ON idempotency_keys (created_at)
+            ''')
+            
+            cursor.execute('''
+                ALTER TABLE withdrawals
+                ADD COLUMN IF NOT EXISTS decided_time TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS request_recorded BOOLEAN DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS decision_recorded BOOLEAN DEFAULT FALSE
+            ''')
+            
+            cursor.execute('''
+                ALTER TABLE games
+                ADD COLUMN IF NOT EXISTS stats_recorded BOOLEAN DEFAULT FALSE
+            ''')
+            
+            # Keep backfill-stats chunks from rescanning rows already rolled up
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_games_stats_unrecorded
+                ON games (game_id)
+                WHERE status = 'finished' AND NOT stats_recorded
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_withdrawals_request_unrecorded
+                ON withdrawals (withdraw_id)
+                WHERE NOT request_recorded
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_withdrawals_decision_unrecorded
+                ON withdrawals (withdraw_id)
+                WHERE status IN ('approved', 'rejected') AND NOT decision_recorded
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS game_stats (
+                    granularity TEXT,
+                    bucket TIMESTAMP,
+                    bet_amount INTEGER,
+                    games INTEGER DEFAULT 0,
+                    pot_total BIGINT DEFAULT 0,
+                    prize_total BIGINT DEFAULT 0,
+                    house_revenue BIGINT DEFAULT 0,
+                    PRIMARY KEY (granularity, bucket, bet_amount)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS activity_stats (
+                    granularity TEXT,
+                    bucket TIMESTAMP,
+                    active_players INTEGER DEFAULT 0,
+                    withdrawals_requested INTEGER DEFAULT 0,
+                    withdrawal_requested_amount BIGINT DEFAULT 0,
+                    withdrawals_approved INTEGER DEFAULT 0,
+                    withdrawal_approved_amount BIGINT DEFAULT 0,
+                    withdrawals_rejected INTEGER DEFAULT 0,
+                    withdrawal_rejected_amount BIGINT DEFAULT 0,
+                    PRIMARY KEY (granularity, bucket)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS active_players (
+                    granularity TEXT,
+                    bucket TIMESTAMP,
+                    user_id BIGINT,
+                    PRIMARY KEY (granularity, bucket, user_id)
+                )
+            ''')
+            
             conn.commit()
     except Exception as e:
         logger.error(f"Error initializing database: {str(e)}")
@@ -126,7 +302,7 @@ def generate_referral_code(user_id):
     return hashlib.md5(str(user_id).encode()).hexdigest()[:8]
 
 def generate_tx_id(user_id):
-    return f"TX{user_id}{''.join(random.choices(string.ascii_uppercase + string.digits, k=6))}"
+    return f"TX{user_id}{''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(6))}"
 
 def generate_withdraw_id(user_id):
     return f"WD{user_id}{random.randint(1000, 9999)}"
@@ -138,6 +314,802 @@ def generate_card_numbers():
     numbers = random.sample(range(1, 101), 25)
     return ','.join(map(str, numbers))
 
+# Idempotency keys
+# Clients send an Idempotency-Key header on money- and game-mutating POSTs so
+# that a retried request replays the stored response instead of running again.
+idempotency_cache = OrderedDict()
+idempotency_lock = threading.Lock()
+
+def idempotency_cache_get(cache_key):
+    with idempotency_lock:
+        entry = idempotency_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[0] < datetime.utcnow():
+            del idempotency_cache[cache_key]
+            return None
+        idempotency_cache.move_to_end(cache_key)
+        return entry[1], entry[2]
+
+def idempotency_cache_put(cache_key, status_code, body):
+    with idempotency_lock:
+        idempotency_cache[cache_key] = (datetime.utcnow() + IDEMPOTENCY_TTL, status_code, body)
+        idempotency_cache.move_to_end(cache_key)
+        while len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+            idempotency_cache.popitem(last=False)
+
+def replay_response(status_code, body):
+    response = app.response_class(body, status=status_code, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def claim_idempotency_key(cache_key):
+    """Claim the key for this request or return the stored (status_code, body).
+
+    Returns None when the caller owns the key and should run the view. A claim
+    left behind by a crashed request can be taken over after
+    IDEMPOTENCY_CLAIM_TIMEOUT; an expired key is reused.
+    """
+    user_id, endpoint, idem_key = cache_key
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO idempotency_keys (idem_key, endpoint, user_id)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, endpoint, idem_key) DO UPDATE
+                SET status_code = NULL, response = NULL, created_at = NOW()
+                WHERE idempotency_keys.created_at < NOW() - %s
+                   OR (idempotency_keys.status_code IS NULL
+                       AND idempotency_keys.created_at < NOW() - %s)
+                """,
+                (idem_key, endpoint, user_id, IDEMPOTENCY_TTL, IDEMPOTENCY_CLAIM_TIMEOUT))
+            claimed = cursor.rowcount == 1
+            conn.commit()
+
+            if claimed:
+                return None
+
+            cursor.execute(
+                """
+                SELECT status_code, response FROM idempotency_keys
+                WHERE user_id = %s AND endpoint = %s AND idem_key = %s
+                """,
+                (user_id, endpoint, idem_key))
+            return cursor.fetchone()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def store_idempotency_key(cache_key, status_code, body):
+    user_id, endpoint, idem_key = cache_key
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            if status_code >= 500:
+                # Let the client retry a request that failed server-side
+                cursor.execute(
+                    "DELETE FROM idempotency_keys WHERE user_id = %s AND endpoint = %s AND idem_key = %s",
+                    (user_id, endpoint, idem_key))
+            else:
+                cursor.execute(
+                    """
+                    UPDATE idempotency_keys SET status_code = %s, response = %s
+                    WHERE user_id = %s AND endpoint = %s AND idem_key = %s
+                    """,
+                    (status_code, body, user_id, endpoint, idem_key))
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error storing idempotency key: {str(e)}")
+    finally:
+        release_db_connection(conn)
+
+def idempotent(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        idem_key = request.headers.get('Idempotency-Key')
+        data = request.get_json(silent=True) or {}
+        user_id = str(data.get('user_id', ''))
+
+        if not idem_key or len(idem_key) > 128 or not user_id.isdigit():
+            return view(*args, **kwargs)
+
+        cache_key = (int(user_id), request.endpoint, idem_key)
+        cached = idempotency_cache_get(cache_key)
+        if cached:
+            return replay_response(*cached)
+
+        try:
+            stored = claim_idempotency_key(cache_key)
+        except Exception as e:
+            logger.error(f"Error claiming idempotency key: {str(e)}")
+            return jsonify({'status': 'failed', 'reason': 'Database error'}), 500
+
+        if stored:
+            if stored[0] is None:
+                return jsonify({'status': 'failed', 'reason': 'Request already in progress'}), 409
+            idempotency_cache_put(cache_key, stored[0], stored[1])
+            return replay_response(stored[0], stored[1])
+
+        response = make_response(view(*args, **kwargs))
+        body = response.get_data(as_text=True)
+        store_idempotency_key(cache_key, response.status_code, body)
+        if response.status_code < 500:
+            idempotency_cache_put(cache_key, response.status_code, body)
+        return response
+    return wrapper
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys():
+    """Delete idempotency keys older than IDEMPOTENCY_TTL."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < NOW() - %s",
+                (IDEMPOTENCY_TTL,))
+            conn.commit()
+            logger.info(f"Purged {cursor.rowcount} idempotency keys")
+    finally:
+        release_db_connection(conn)
+
+# Referrals
+def record_referral(cursor, referral_code, referred_id):
+    """Link a newly registered user to the owner of referral_code.
+
+    Accepts either a user's referral_code or the ref_<user_id> form used in
+    the invite link. Runs in the caller's transaction and keeps
+    users.referral_count in step with the referrals table so invite_data
+    never has to count rows.
+    """
+    referrer_id = None
+    if referral_code.startswith('ref_') and referral_code[4:].isdigit():
+        referrer_id = int(referral_code[4:])
+    
+    cursor.execute(
+        """
+        INSERT INTO referrals (referred_id, referrer_id)
+        SELECT %s, user_id FROM users
+        WHERE (referral_code = %s OR user_id = %s) AND user_id <> %s
+        LIMIT 1
+        ON CONFLICT (referred_id) DO NOTHING
+        RETURNING referrer_id
+        """,
+        (referred_id, referral_code, referrer_id, referred_id))
+    referrer = cursor.fetchone()
+    
+    if referrer:
+        cursor.execute(
+            "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = %s",
+            (referrer[0],))
+
+def credit_referral_bonuses(batch_size=REFERRAL_BONUS_BATCH_SIZE):
+    """Pay REFERRAL_BONUS_AMOUNT for every REFERRAL_BONUS_THRESHOLD referrals not yet paid.
+
+    Works through eligible users in batches of batch_size, one transaction per
+    batch. Rows locked by another worker are skipped. Returns the number of
+    users credited.
+    """
+    credited = 0
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute(
+                    """
+                    UPDATE users
+                    SET wallet = wallet + (referral_count / %(threshold)s - referral_bonuses_paid) * %(amount)s,
+                        referral_bonuses_paid = referral_count / %(threshold)s
+                    WHERE user_id IN (
+                        SELECT user_id FROM users
+                        WHERE referral_count / %(threshold)s > referral_bonuses_paid
+                        LIMIT %(batch_size)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    """,
+                    {
+                        'threshold': REFERRAL_BONUS_THRESHOLD,
+                        'amount': REFERRAL_BONUS_AMOUNT,
+                        'batch_size': batch_size
+                    })
+                batch = cursor.rowcount
+                conn.commit()
+                credited += batch
+                
+                if batch < batch_size:
+                    return credited
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+@app.cli.command('credit-referral-bonuses')
+@click.option('--interval', type=int, default=0, help='Seconds between runs; 0 runs once.')
+def credit_referral_bonuses_command(interval):
+    """Credit referral bonuses, optionally repeating every --interval seconds."""
+    while True:
+        try:
+            logger.info(f"Credited referral bonuses to {credit_referral_bonuses()} users")
+        except Exception as e:
+            logger.error(f"Error crediting referral bonuses: {str(e)}")
+        
+        if not interval:
+            break
+        time.sleep(interval)
+
+# Analytics
+# Rollup tables are updated in the same transaction as the game or withdrawal
+# change they count, so /api/admin/stats never scans games or withdrawals.
+# Each upsert takes a source query yielding one row per event and folds it
+# into every granularity in STATS_GRANULARITIES. The same transaction sets
+# games.stats_recorded or withdrawals.request_recorded/decision_recorded, so
+# backfill-stats only has to fold in the history left unmarked.
+GAME_STATS_UPSERT = """
+    INSERT INTO game_stats (granularity, bucket, bet_amount, games, pot_total, prize_total, house_revenue)
+    SELECT g.granularity, date_trunc(g.granularity, src.ts), src.bet_amount,
+           COUNT(*), SUM(src.pot), SUM(src.prize), SUM(src.pot - src.prize)
+    FROM ({source}) AS src
+    CROSS JOIN unnest(%(granularities)s::text[]) AS g(granularity)
+    GROUP BY 1, 2, 3
+    ON CONFLICT (granularity, bucket, bet_amount) DO UPDATE
+    SET games = game_stats.games + EXCLUDED.games,
+        pot_total = game_stats.pot_total + EXCLUDED.pot_total,
+        prize_total = game_stats.prize_total + EXCLUDED.prize_total,
+        house_revenue = game_stats.house_revenue + EXCLUDED.house_revenue
+"""
+
+ACTIVE_PLAYERS_UPSERT = """
+    WITH new_players AS (
+        INSERT INTO active_players (granularity, bucket, user_id)
+        SELECT DISTINCT g.granularity, date_trunc(g.granularity, src.ts), src.user_id
+        FROM ({source}) AS src
+        CROSS JOIN unnest(%(granularities)s::text[]) AS g(granularity)
+        ON CONFLICT DO NOTHING
+        RETURNING granularity, bucket
+    )
+    INSERT INTO activity_stats (granularity, bucket, active_players)
+    SELECT granularity, bucket, COUNT(*) FROM new_players GROUP BY 1, 2
+    ON CONFLICT (granularity, bucket) DO UPDATE
+    SET active_players = activity_stats.active_players + EXCLUDED.active_players
+"""
+
+WITHDRAWAL_STATS_UPSERT = """
+    INSERT INTO activity_stats (
+        granularity, bucket,
+        withdrawals_requested, withdrawal_requested_amount,
+        withdrawals_approved, withdrawal_approved_amount,
+        withdrawals_rejected, withdrawal_rejected_amount
+    )
+    SELECT g.granularity, date_trunc(g.granularity, src.ts),
+           COUNT(*) FILTER (WHERE src.status = 'requested'),
+           COALESCE(SUM(src.amount) FILTER (WHERE src.status = 'requested'), 0),
+           COUNT(*) FILTER (WHERE src.status = 'approved'),
+           COALESCE(SUM(src.amount) FILTER (WHERE src.status = 'approved'), 0),
+           COUNT(*) FILTER (WHERE src.status = 'rejected'),
+           COALESCE(SUM(src.amount) FILTER (WHERE src.status = 'rejected'), 0)
+    FROM ({source}) AS src
+    CROSS JOIN unnest(%(granularities)s::text[]) AS g(granularity)
+    GROUP BY 1, 2
+    ON CONFLICT (granularity, bucket) DO UPDATE
+    SET withdrawals_requested = activity_stats.withdrawals_requested + EXCLUDED.withdrawals_requested,
+        withdrawal_requested_amount = activity_stats.withdrawal_requested_amount + EXCLUDED.withdrawal_requested_amount,
+        withdrawals_approved = activity_stats.withdrawals_approved + EXCLUDED.withdrawals_approved,
+        withdrawal_approved_amount = activity_stats.withdrawal_approved_amount + EXCLUDED.withdrawal_approved_amount,
+        withdrawals_rejected = activity_stats.withdrawals_rejected + EXCLUDED.withdrawals_rejected,
+        withdrawal_rejected_amount = activity_stats.withdrawal_rejected_amount + EXCLUDED.withdrawal_rejected_amount
+"""
+
+def record_game_finished(cursor, game_id, bet_amount, prize_amount):
+    # Participants come from player_cards: players kicked for a false bingo
+    # have left games.players but their bet stays in the pot
+    params = {
+        'granularities': STATS_GRANULARITIES,
+        'game_id': game_id,
+        'bet_amount': bet_amount,
+        'prize': prize_amount
+    }
+    cursor.execute(GAME_STATS_UPSERT.format(source="""
+        SELECT LOCALTIMESTAMP AS ts, %(bet_amount)s AS bet_amount,
+               %(bet_amount)s * COUNT(DISTINCT user_id) AS pot, %(prize)s AS prize
+        FROM player_cards
+        WHERE game_id = %(game_id)s
+    """), params)
+    cursor.execute(ACTIVE_PLAYERS_UPSERT.format(source="""
+        SELECT DISTINCT LOCALTIMESTAMP AS ts, user_id
+        FROM player_cards
+        WHERE game_id = %(game_id)s
+    """), params)
+
+def record_withdrawal(cursor, status, amount):
+    cursor.execute(WITHDRAWAL_STATS_UPSERT.format(source="""
+        SELECT LOCALTIMESTAMP AS ts, %(status)s AS status, %(amount)s AS amount
+    """), {'granularities': STATS_GRANULARITIES, 'status': status, 'amount': amount})
+
+@app.cli.command('backfill-stats')
+@click.option('--chunk-size', type=int, default=1000, help='Games or withdrawals per transaction.')
+def backfill_stats(chunk_size):
+    """Fold history not yet in the analytics rollups into them.
+
+    Only games and withdrawal events whose marker is still unset are read,
+    in chunks of chunk_size, and each chunk sets its markers in the same
+    transaction as its upserts. Live writers mark their own rows, and rows
+    they have locked are skipped, so the command never takes a table lock,
+    never counts an event twice and can be stopped and re-run at any time.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            params = {'granularities': STATS_GRANULARITIES, 'chunk_size': chunk_size}
+            while True:
+                cursor.execute(
+                    """
+                    UPDATE games SET stats_recorded = TRUE
+                    WHERE game_id IN (
+                        SELECT game_id FROM games
+                        WHERE status = 'finished' AND NOT stats_recorded
+                        LIMIT %(chunk_size)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING game_id
+                    """,
+                    params)
+                params['game_ids'] = [row[0] for row in cursor.fetchall()]
+                
+                cursor.execute(GAME_STATS_UPSERT.format(source="""
+                    SELECT games.end_time AS ts, games.bet_amount,
+                           games.bet_amount * COUNT(DISTINCT player_cards.user_id) AS pot,
+                           games.prize_amount AS prize
+                    FROM games
+                    LEFT JOIN player_cards ON player_cards.game_id = games.game_id
+                    WHERE games.game_id = ANY(%(game_ids)s)
+                    GROUP BY games.game_id
+                """), params)
+                
+                cursor.execute(ACTIVE_PLAYERS_UPSERT.format(source="""
+                    SELECT DISTINCT games.end_time AS ts, player_cards.user_id
+                    FROM games
+                    JOIN player_cards ON player_cards.game_id = games.game_id
+                    WHERE games.game_id = ANY(%(game_ids)s)
+                """), params)
+                
+                cursor.execute(
+                    """
+                    UPDATE withdrawals SET request_recorded = TRUE
+                    WHERE withdraw_id IN (
+                        SELECT withdraw_id FROM withdrawals
+                        WHERE NOT request_recorded
+                        LIMIT %(chunk_size)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING withdraw_id
+                    """,
+                    params)
+                params['request_ids'] = [row[0] for row in cursor.fetchall()]
+                
+                cursor.execute(
+                    """
+                    UPDATE withdrawals SET decision_recorded = TRUE
+                    WHERE withdraw_id IN (
+                        SELECT withdraw_id FROM withdrawals
+                        WHERE status IN ('approved', 'rejected') AND NOT decision_recorded
+                        LIMIT %(chunk_size)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING withdraw_id
+                    """,
+                    params)
+                params['decision_ids'] = [row[0] for row in cursor.fetchall()]
+                
+                cursor.execute(WITHDRAWAL_STATS_UPSERT.format(source="""
+                    SELECT request_time AS ts, 'requested' AS status, amount
+                    FROM withdrawals
+                    WHERE withdraw_id = ANY(%(request_ids)s)
+                    UNION ALL
+                    SELECT COALESCE(decided_time, request_time) AS ts, status, amount
+                    FROM withdrawals
+                    WHERE withdraw_id = ANY(%(decision_ids)s)
+                """), params)
+                
+                conn.commit()
+                backfilled = max(len(params['game_ids']), len(params['request_ids']), len(params['decision_ids']))
+                logger.info(
+                    f"Backfilled stats for {len(params['game_ids'])} games and "
+                    f"{len(params['request_ids']) + len(params['decision_ids'])} withdrawal events")
+                
+                if backfilled < chunk_size:
+                    break
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+# Profiling
+# A sampled request, or one carrying X-Profile-Token, has its thread's stack
+# sampled every PROFILE_INTERVAL seconds, about 200 samples a second. The
+# sampler needs the GIL to read frames, and a busy thread only gives it up
+# every switch interval (5 ms by default), which would thin out samples of
+# CPU-bound code. While any sampler runs the switch interval is lowered to
+# PROFILE_SWITCH_INTERVAL, so samples land within 1 ms of schedule whether
+# the request is running Python or waiting on I/O. Stacks are written in
+# the folded format read by flamegraph.pl and speedscope, keeping the newest
+# PROFILE_RETENTION profiles per route. No hooks are registered unless
+# PROFILE_SAMPLE_RATE or PROFILE_TOKEN is set.
+class StackSampler(threading.Thread):
+    active = 0
+    active_lock = threading.Lock()
+    saved_switch_interval = None
+
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def start(self):
+        with StackSampler.active_lock:
+            if StackSampler.active == 0:
+                StackSampler.saved_switch_interval = sys.getswitchinterval()
+                sys.setswitchinterval(PROFILE_SWITCH_INTERVAL)
+            StackSampler.active += 1
+        super().start()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        with StackSampler.active_lock:
+            StackSampler.active -= 1
+            if StackSampler.active == 0:
+                sys.setswitchinterval(StackSampler.saved_switch_interval)
+        return self.stacks
+
+profile_random = random.Random()
+
+def start_profiling():
+    token = request.headers.get('X-Profile-Token')
+    requested = bool(PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN))
+    
+    if requested or profile_random.random() < PROFILE_SAMPLE_RATE:
+        g.stack_sampler = StackSampler(threading.get_ident())
+        g.stack_sampler.start()
+
+def finish_profiling(exc):
+    sampler = g.pop('stack_sampler', None)
+    if sampler is None:
+        return
+    
+    stacks = sampler.stop()
+    if not stacks:
+        return
+    
+    endpoint = request.endpoint or 'unknown'
+    try:
+        path = os.path.join(PROFILE_DIR, f"{endpoint}.{time.time_ns()}.folded")
+        with open(path, 'w') as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        
+        for old_path in sorted(glob.glob(os.path.join(PROFILE_DIR, f"{endpoint}.*.folded")))[:-PROFILE_RETENTION]:
+            os.remove(old_path)
+    except OSError as e:
+        logger.error(f"Error writing profile for {endpoint}: {str(e)}")
+
+def load_profiles():
+    """Aggregate the retained profiles into a folded-stack Counter per route."""
+    profiles = {}
+    for path in glob.glob(os.path.join(PROFILE_DIR, '*.folded')):
+        endpoint = os.path.basename(path).split('.')[0]
+        stacks = profiles.setdefault(endpoint, Counter())
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+    return profiles
+
+if PROFILE_SAMPLE_RATE > 0 or PROFILE_TOKEN:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    app.before_request(start_profiling)
+    app.teardown_request(finish_profiling)
+
+# Game settlement
+def settle_game(cursor, game_id, winner_id, bet_amount, prize_amount):
+    """Finish game_id and settle every participant in the caller's transaction.
+
+    Participants are taken from player_cards, so players kicked for a false
+    bingo still get the game and their wager counted. Returns False without
+    paying anyone if the game already has a winner; the row lock taken by
+    the first UPDATE makes concurrent winning claims settle only once.
+    """
+    cursor.execute(
+        """
+        UPDATE games 
+        SET winner_id = %s, 
+            prize_amount = %s, 
+            status = 'finished', 
+            end_time = NOW(),
+            stats_recorded = TRUE
+        WHERE game_id = %s AND winner_id IS NULL
+        RETURNING 1
+        """,
+        (winner_id, prize_amount, game_id))
+    
+    if cursor.fetchone() is None:
+        return False
+    
+    cursor.execute(
+        "UPDATE users SET wallet = wallet + %s, score = score + 1 WHERE user_id = %s",
+        (prize_amount, winner_id))
+    
+    cursor.execute(
+        """
+        WITH participants AS (
+            UPDATE player_cards SET finished = TRUE
+            WHERE game_id = %(game_id)s AND NOT finished
+            RETURNING user_id
+        )
+        INSERT INTO user_stats (user_id, games_played, wins, total_wagered, total_won)
+        SELECT user_id, 1,
+               CASE WHEN user_id = %(winner_id)s THEN 1 ELSE 0 END,
+               %(bet_amount)s,
+               CASE WHEN user_id = %(winner_id)s THEN %(prize_amount)s ELSE 0 END
+        FROM (SELECT DISTINCT user_id FROM participants) AS settled
+        ON CONFLICT (user_id) DO UPDATE
+        SET games_played = user_stats.games_played + EXCLUDED.games_played,
+            wins = user_stats.wins + EXCLUDED.wins,
+            total_wagered = user_stats.total_wagered + EXCLUDED.total_wagered,
+            total_won = user_stats.total_won + EXCLUDED.total_won
+        """,
+        {
+            'game_id': game_id,
+            'winner_id': winner_id,
+            'bet_amount': bet_amount,
+            'prize_amount': prize_amount
+        })
+    
+    record_game_finished(cursor, game_id, bet_amount, prize_amount)
+    return True
+
+def record_invalid_bingo(cursor, user_id):
+    cursor.execute(
+        "UPDATE users SET invalid_bingo_count = invalid_bingo_count + 1 WHERE user_id = %s",
+        (user_id,))
+    
+    cursor.execute(
+        """
+        INSERT INTO user_stats (user_id, invalid_bingo_count) VALUES (%s, 1)
+        ON CONFLICT (user_id) DO UPDATE
+        SET invalid_bingo_count = user_stats.invalid_bingo_count + 1
+        """,
+        (user_id,))
+
+@app.cli.command('backfill-user-stats')
+def backfill_user_stats():
+    """Rebuild user_stats from finished games and users.invalid_bingo_count."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("TRUNCATE user_stats")
+            cursor.execute(
+                """
+                UPDATE player_cards SET finished = TRUE
+                FROM games
+                WHERE player_cards.game_id = games.game_id
+                  AND games.status = 'finished'
+                  AND NOT player_cards.finished
+                """)
+            cursor.execute(
+                """
+                INSERT INTO user_stats (user_id, games_played, wins, total_wagered, total_won, invalid_bingo_count)
+                SELECT users.user_id,
+                       COUNT(games.game_id),
+                       COUNT(games.game_id) FILTER (WHERE games.winner_id = users.user_id),
+                       COALESCE(SUM(games.bet_amount), 0),
+                       COALESCE(SUM(games.prize_amount) FILTER (WHERE games.winner_id = users.user_id), 0),
+                       users.invalid_bingo_count
+                FROM users
+                LEFT JOIN (SELECT DISTINCT game_id, user_id FROM player_cards WHERE finished) AS cards
+                    ON cards.user_id = users.user_id
+                LEFT JOIN games ON games.game_id = cards.game_id
+                GROUP BY users.user_id, users.invalid_bingo_count
+                """)
+            conn.commit()
+            logger.info(f"Backfilled stats for {cursor.rowcount} users")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+# Deposits
+# /api/deposit only records a pending transaction. Workers started with the
+# verify-deposits command claim rows whose next_attempt_at has passed, check
+# them against the configured payment provider outside any transaction, and
+# settle each batch with set-based updates. Deposits the provider has not
+# seen yet are retried with exponential backoff, so they never starve newer
+# ones.
+class PaymentProvider:
+    def verify(self, deposits):
+        """Verify a batch of (tx_id, amount, method, verification_code) tuples.
+
+        Returns {tx_id: result} where result is True for a confirmed payment,
+        False for a rejected one and None when the provider has not seen it yet.
+        """
+        raise NotImplementedError
+
+class FakePaymentProvider(PaymentProvider):
+    """Local provider that confirms payments registered with add_payment."""
+
+    def __init__(self, payments=None):
+        self.payments = dict(payments or {})
+
+    def add_payment(self, verification_code, amount):
+        self.payments[verification_code] = amount
+
+    def verify(self, deposits):
+        results = {}
+        for tx_id, amount, method, verification_code in deposits:
+            paid = self.payments.get(verification_code)
+            results[tx_id] = None if paid is None else paid == amount
+        return results
+
+# PAYMENT_PROVIDER has no default; 'fake' is for tests and local development
+PAYMENT_PROVIDERS = {
+    'fake': FakePaymentProvider
+}
+
+def claim_pending_deposits(batch_size=DEPOSIT_BATCH_SIZE):
+    """Mark up to batch_size due deposits as verifying and return them.
+
+    The claim pushes next_attempt_at out by DEPOSIT_CLAIM_TIMEOUT, so a
+    deposit whose worker died mid-verification becomes due again after that.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE transactions
+                SET status = 'verifying', next_attempt_at = NOW() + %s
+                WHERE tx_id IN (
+                    SELECT tx_id FROM transactions
+                    WHERE status IN ('pending', 'verifying') AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING tx_id, amount, method, verification_code
+                """,
+                (DEPOSIT_CLAIM_TIMEOUT, batch_size))
+            deposits = cursor.fetchall()
+            conn.commit()
+            return deposits
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def settle_deposits(results):
+    """Apply provider results to claimed deposits in one transaction.
+
+    Returns the number of deposits completed or failed.
+    """
+    confirmed = [tx_id for tx_id, result in results.items() if result is True]
+    rejected = [tx_id for tx_id, result in results.items() if result is False]
+    unknown = [tx_id for tx_id, result in results.items() if result is None]
+    
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                WITH confirmed AS (
+                    UPDATE transactions SET status = 'completed'
+                    WHERE tx_id = ANY(%s) AND status = 'verifying'
+                    RETURNING user_id, amount
+                ), credits AS (
+                    SELECT user_id, SUM(amount) AS total FROM confirmed GROUP BY user_id
+                ), credited AS (
+                    UPDATE users SET wallet = users.wallet + credits.total
+                    FROM credits
+                    WHERE users.user_id = credits.user_id
+                )
+                SELECT COUNT(*) FROM confirmed
+                """,
+                (confirmed,))
+            settled = cursor.fetchone()[0]
+            
+            cursor.execute(
+                """
+                UPDATE transactions SET status = 'failed'
+                WHERE status = 'verifying'
+                  AND (tx_id = ANY(%s) OR (tx_id = ANY(%s) AND timestamp < NOW() - %s))
+                """,
+                (rejected, unknown, DEPOSIT_VERIFY_WINDOW))
+            settled += cursor.rowcount
+            
+            # Not seen by the provider yet: back off before asking again. The
+            # exponent is capped so the interval cannot overflow on old rows
+            cursor.execute(
+                """
+                UPDATE transactions
+                SET status = 'pending',
+                    verify_attempts = verify_attempts + 1,
+                    next_attempt_at = NOW() + LEAST(%s * power(2, LEAST(verify_attempts, 10)), %s)
+                WHERE tx_id = ANY(%s) AND status = 'verifying'
+                """,
+                (DEPOSIT_RETRY_BASE, DEPOSIT_RETRY_MAX, unknown))
+            
+            conn.commit()
+            return settled
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def verify_deposits(provider, batch_size=DEPOSIT_BATCH_SIZE):
+    """Claim, verify and settle one batch. Returns the number of deposits settled."""
+    deposits = claim_pending_deposits(batch_size)
+    if not deposits:
+        return 0
+    return settle_deposits(provider.verify(deposits))
+
+def deposit_worker(provider, interval, stopped):
+    while not stopped.is_set():
+        try:
+            settled = verify_deposits(provider)
+        except Exception as e:
+            logger.error(f"Error verifying deposits: {str(e)}")
+            settled = 0
+        
+        # Keep draining only while whole batches are being settled
+        if settled < DEPOSIT_BATCH_SIZE:
+            stopped.wait(interval)
+
+@app.cli.command('verify-deposits')
+@click.option('--workers', type=int, default=2, help='Number of verification threads.')
+@click.option('--interval', type=float, default=5.0, help='Seconds to wait when no deposits are pending.')
+def verify_deposits_command(workers, interval):
+    """Run the deposit verification worker pool until interrupted."""
+    if PAYMENT_PROVIDER not in PAYMENT_PROVIDERS:
+        raise click.UsageError(
+            f"PAYMENT_PROVIDER is not set or unknown (available: {', '.join(sorted(PAYMENT_PROVIDERS))})")
+    if workers > DB_POOL_SIZE:
+        raise click.UsageError(f"--workers cannot exceed the pool size of {DB_POOL_SIZE}")
+    provider = PAYMENT_PROVIDERS[PAYMENT_PROVIDER]()
+    get_db_pool()
+    stopped = threading.Event()
+    threads = [
+        threading.Thread(target=deposit_worker, args=(provider, interval, stopped), daemon=True)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
 # API Endpoints
 @app.route('/api/user_data', methods=['GET'])
 def user_data():
@@ -150,7 +1122,7 @@ def user_data():
         with conn.cursor() as cursor:
             cursor.execute(
                 "SELECT wallet, username, role, invalid_bingo_count FROM users WHERE user_id = %s",
-                (int(user_id),)
+                (int(user_id),))
             data = cursor.fetchone()
             
             if not data:
@@ -183,22 +1155,26 @@ def register():
     conn = get_db_connection()
     try:
         with conn.cursor() as cursor:
-            referral_code = generate_referral_code(user_id)
+            own_referral_code = generate_referral_code(user_id)
             
             cursor.execute(
                 """
-                INSERT INTO users (user_id, phone, username, referral_code, wallet)
-                VALUES (%s, %s, %s, %s, %s)
+                INSERT INTO users (user_id, phone, username, referral_code, referred_by, wallet)
+                VALUES (%s, %s, %s, %s, %s, %s)
                 ON CONFLICT (user_id) DO NOTHING
                 RETURNING wallet, username, role
                 """,
-                (int(user_id), phone, username, referral_code, INITIAL_WALLET)
+                (int(user_id), phone, username, own_referral_code, referral_code or None, INITIAL_WALLET)
             )
             
             if cursor.rowcount == 0:
                 return jsonify({'status': 'failed', 'reason': 'User already exists'}), 400
                 
             user_data = cursor.fetchone()
+            
+            if referral_code:
+                record_referral(cursor, referral_code, int(user_id))
+            
             conn.commit()
             
             return jsonify({
@@ -215,6 +1191,7 @@ def register():
         release_db_connection(conn)
 
 @app.route('/api/join_game', methods=['POST'])
+@idempotent
 def join_game():
     data = request.get_json()
     user_id = data.get('user_id')
@@ -229,7 +1206,7 @@ def join_game():
             # Check user balance
             cursor.execute(
                 "SELECT wallet FROM users WHERE user_id = %s",
-                (int(user_id),)
+                (int(user_id),))
             wallet = cursor.fetchone()
             
             if not wallet or wallet[0] < bet_amount:
@@ -502,6 +1479,7 @@ def call_number():
         release_db_connection(conn)
 
 @app.route('/api/check_bingo', methods=['POST'])
+@idempotent
 def check_bingo():
     data = request.get_json()
     user_id = data.get('user_id')
@@ -559,9 +1537,7 @@ def check_bingo():
                     "UPDATE games SET players = %s WHERE game_id = %s",
                     (','.join(players), game_id))
                 
-                cursor.execute(
-                    "UPDATE users SET invalid_bingo_count = invalid_bingo_count + 1 WHERE user_id = %s",
-                    (int(user_id),))
+                record_invalid_bingo(cursor, int(user_id))
                 
                 conn.commit()
                 return jsonify({
@@ -574,21 +1550,9 @@ def check_bingo():
             total_players = len(players)
             prize_amount = int(bet_amount * total_players * (1 - HOUSE_CUT))
             
-            # Update game and user
-            cursor.execute(
-                """
-                UPDATE games 
-                SET winner_id = %s, 
-                    prize_amount = %s, 
-                    status = 'finished', 
-                    end_time = NOW() 
-                WHERE game_id = %s
-                """,
-                (int(user_id), prize_amount, game_id))
-            
-            cursor.execute(
-                "UPDATE users SET wallet = wallet + %s, score = score + 1 WHERE user_id = %s",
-                (prize_amount, int(user_id)))
+            if not settle_game(cursor, game_id, int(user_id), bet_amount, prize_amount):
+                conn.rollback()
+                return jsonify({'status': 'failed', 'reason': 'Game already has winner'}), 400
             
             conn.commit()
             
@@ -605,6 +1569,7 @@ def check_bingo():
         release_db_connection(conn)
 
 @app.route('/api/request_withdrawal', methods=['POST'])
+@idempotent
 def request_withdrawal():
     data = request.get_json()
     user_id = data.get('user_id')
@@ -633,8 +1598,8 @@ def request_withdrawal():
             withdraw_id = generate_withdraw_id(user_id)
             cursor.execute(
                 """
-                INSERT INTO withdrawals (withdraw_id, user_id, amount, method)
-                VALUES (%s, %s, %s, %s)
+                INSERT INTO withdrawals (withdraw_id, user_id, amount, method, request_recorded)
+                VALUES (%s, %s, %s, %s, TRUE)
                 """,
                 (withdraw_id, int(user_id), amount, method))
             
@@ -643,6 +1608,8 @@ def request_withdrawal():
                 "UPDATE users SET wallet = wallet - %s WHERE user_id = %s",
                 (amount, int(user_id)))
             
+            record_withdrawal(cursor, 'requested', amount)
+            
             conn.commit()
             
             return jsonify({
@@ -657,6 +1624,77 @@ def request_withdrawal():
     finally:
         release_db_connection(conn)
 
+@app.route('/api/deposit', methods=['POST'])
+@idempotent
+def deposit():
+    data = request.get_json()
+    user_id = data.get('user_id')
+    amount = data.get('amount')
+    method = data.get('method', 'telebirr')
+    verification_code = data.get('verification_code')
+    
+    if not all([user_id, amount, verification_code]) or amount < MINIMUM_DEPOSIT:
+        return jsonify({'status': 'failed', 'reason': f'Minimum deposit is {MINIMUM_DEPOSIT} ETB'}), 400
+    
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            tx_id = generate_tx_id(user_id)
+            cursor.execute(
+                """
+                INSERT INTO transactions (tx_id, user_id, amount, method, verification_code)
+                SELECT %s, user_id, %s, %s, %s FROM users WHERE user_id = %s
+                ON CONFLICT (method, verification_code) DO NOTHING
+                """,
+                (tx_id, amount, method, verification_code, int(user_id)))
+            
+            if cursor.rowcount == 0:
+                return jsonify({'status': 'failed', 'reason': 'Unknown user or verification code already used'}), 400
+            
+            conn.commit()
+            
+            return jsonify({
+                'status': 'pending',
+                'tx_id': tx_id,
+                'amount': amount
+            })
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error in deposit: {str(e)}")
+        return jsonify({'status': 'failed', 'reason': 'Database error'}), 500
+    finally:
+        release_db_connection(conn)
+
+@app.route('/api/deposit_status', methods=['GET'])
+def deposit_status():
+    user_id = request.args.get('user_id')
+    tx_id = request.args.get('tx_id')
+    
+    if not user_id or not user_id.isdigit() or not tx_id:
+        return jsonify({'error': 'Valid user_id and tx_id required'}), 400
+    
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT status, amount FROM transactions WHERE tx_id = %s AND user_id = %s",
+                (tx_id, int(user_id)))
+            tx = cursor.fetchone()
+            
+            if not tx:
+                return jsonify({'status': 'not_found'}), 404
+            
+            return jsonify({
+                'tx_id': tx_id,
+                'status': tx[0],
+                'amount': tx[1]
+            })
+    except Exception as e:
+        logger.error(f"Error in deposit_status: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    finally:
+        release_db_connection(conn)
+
 @app.route('/api/pending_withdrawals', methods=['GET'])
 def pending_withdrawals():
     user_id = request.args.get('user_id')
@@ -741,8 +1779,13 @@ def admin_actions():
                 
                 if action_type == 'approve':
                     cursor.execute(
-                        "UPDATE withdrawals SET status = 'approved', admin_note = %s WHERE withdraw_id = %s",
+                        """
+                        UPDATE withdrawals
+                        SET status = 'approved', admin_note = %s, decided_time = NOW(), decision_recorded = TRUE
+                        WHERE withdraw_id = %s
+                        """,
                         (admin_note, withdraw_id))
+                    record_withdrawal(cursor, 'approved', withdrawal[1])
                 elif action_type == 'reject':
                     # Return funds if rejecting
                     cursor.execute(
@@ -750,8 +1793,13 @@ def admin_actions():
                         (withdrawal[1], withdrawal[0]))
                     
                     cursor.execute(
-                        "UPDATE withdrawals SET status = 'rejected', admin_note = %s WHERE withdraw_id = %s",
+                        """
+                        UPDATE withdrawals
+                        SET status = 'rejected', admin_note = %s, decided_time = NOW(), decision_recorded = TRUE
+                        WHERE withdraw_id = %s
+                        """,
                         (admin_note, withdraw_id))
+                    record_withdrawal(cursor, 'rejected', withdrawal[1])
                 else:
                     return jsonify({'status': 'failed', 'reason': 'Invalid action type'}), 400
                 
@@ -766,6 +1814,170 @@ def admin_actions():
     finally:
         release_db_connection(conn)
 
+@app.route('/api/admin/stats', methods=['GET'])
+def admin_stats():
+    user_id = request.args.get('user_id')
+    granularity = request.args.get('granularity', 'day')
+    limit = request.args.get('limit', '30')
+    
+    if not user_id or not user_id.isdigit():
+        return jsonify({'error': 'Valid user_id required'}), 400
+    
+    if granularity not in STATS_GRANULARITIES or not limit.isdigit():
+        return jsonify({'error': 'Invalid parameters'}), 400
+    
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT role FROM users WHERE user_id = %s",
+                (int(user_id),))
+            role = cursor.fetchone()
+            
+            if not role or role[0] != 'admin':
+                return jsonify({'status': 'unauthorized'}), 403
+            
+            cursor.execute(
+                """
+                SELECT bucket, bet_amount, games, pot_total, prize_total, house_revenue
+                FROM game_stats
+                WHERE granularity = %s AND bucket >= (
+                    SELECT COALESCE(MIN(bucket), '-infinity') FROM (
+                        SELECT DISTINCT bucket FROM game_stats
+                        WHERE granularity = %s
+                        ORDER BY bucket DESC LIMIT %s
+                    ) AS recent
+                )
+                ORDER BY bucket DESC, bet_amount
+                """,
+                (granularity, granularity, int(limit)))
+            
+            games = [
+                {
+                    'bucket': row[0].isoformat(),
+                    'bet_amount': row[1],
+                    'games': row[2],
+                    'pot_total': row[3],
+                    'prize_total': row[4],
+                    'house_revenue': row[5]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            cursor.execute(
+                """
+                SELECT bucket, active_players,
+                       withdrawals_requested, withdrawal_requested_amount,
+                       withdrawals_approved, withdrawal_approved_amount,
+                       withdrawals_rejected, withdrawal_rejected_amount
+                FROM activity_stats
+                WHERE granularity = %s
+                ORDER BY bucket DESC
+                LIMIT %s
+                """,
+                (granularity, int(limit)))
+            
+            activity = [
+                {
+                    'bucket': row[0].isoformat(),
+                    'active_players': row[1],
+                    'withdrawals_requested': row[2],
+                    'withdrawal_requested_amount': row[3],
+                    'withdrawals_approved': row[4],
+                    'withdrawal_approved_amount': row[5],
+                    'withdrawals_rejected': row[6],
+                    'withdrawal_rejected_amount': row[7]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            return jsonify({
+                'granularity': granularity,
+                'games': games,
+                'activity': activity
+            })
+    except Exception as e:
+        logger.error(f"Error in admin_stats: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    finally:
+        release_db_connection(conn)
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def admin_profiles():
+    user_id = request.args.get('user_id')
+    route = request.args.get('route')
+    
+    if not user_id or not user_id.isdigit():
+        return jsonify({'error': 'Valid user_id required'}), 400
+    
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT role FROM users WHERE user_id = %s",
+                (int(user_id),))
+            role = cursor.fetchone()
+            
+            if not role or role[0] != 'admin':
+                return jsonify({'status': 'unauthorized'}), 403
+    except Exception as e:
+        logger.error(f"Error in admin_profiles: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    finally:
+        release_db_connection(conn)
+    
+    try:
+        profiles = load_profiles()
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading profiles: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    
+    if not route:
+        return jsonify({
+            'routes': {
+                endpoint: {'samples': sum(stacks.values())}
+                for endpoint, stacks in profiles.items()
+            }
+        })
+    
+    if route not in profiles:
+        return jsonify({'error': 'No profiles for route'}), 404
+    
+    # Folded stacks, ready for flamegraph.pl or speedscope
+    folded = ''.join(f"{stack} {count}\n" for stack, count in profiles[route].most_common())
+    return app.response_class(folded, mimetype='text/plain')
+
+@app.route('/api/user_stats', methods=['GET'])
+def user_stats():
+    user_id = request.args.get('user_id')
+    
+    if not user_id or not user_id.isdigit():
+        return jsonify({'error': 'Valid user_id required'}), 400
+    
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT games_played, wins, total_wagered, total_won, invalid_bingo_count
+                FROM user_stats WHERE user_id = %s
+                """,
+                (int(user_id),))
+            stats = cursor.fetchone() or (0, 0, 0, 0, 0)
+            
+            return jsonify({
+                'games_played': stats[0],
+                'wins': stats[1],
+                'total_wagered': stats[2],
+                'total_won': stats[3],
+                'invalid_bingo_count': stats[4]
+            })
+    except Exception as e:
+        logger.error(f"Error in user_stats: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+    finally:
+        release_db_connection(conn)
+
 @app.route('/api/leaderboard', methods=['GET'])
 def leaderboard():
     conn = get_db_connection()
@@ -807,24 +2019,21 @@ def invite_data():
     try:
         with conn.cursor() as cursor:
             cursor.execute(
-                "SELECT referral_code FROM users WHERE user_id = %s",
+                "SELECT referral_code, referral_count FROM users WHERE user_id = %s",
                 (int(user_id),))
             result = cursor.fetchone()
             
             if not result:
                 return jsonify({'error': 'User not found'}), 404
             
-            referral_code = result[0]
-            cursor.execute(
-                "SELECT COUNT(*) FROM referrals WHERE referrer_id = %s",
-                (int(user_id),))
-            referral_count = cursor.fetchone()[0]
+            referral_code, referral_count = result
             
             return jsonify({
                 'referral_link': f"https://t.me/YOUR_BOT_USERNAME?start=ref_{user_id}",
+                'referral_code': referral_code,
                 'referral_count': referral_count,
-                'bonus_threshold': 20,
-                'bonus_amount': 10
+                'bonus_threshold': REFERRAL_BONUS_THRESHOLD,
+                'bonus_amount': REFERRAL_BONUS_AMOUNT
             })
     except Exception as e:
         logger.error(f"Error in invite_data: {str(e)}")
@@ -0,0 +1,124 @@
+import os
+import re
+import sys
+import shutil
+import hashlib
+import logging
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+# Configuration
+SOURCE_DIR = 'static'
+OUTPUT_DIR = 'dist'
+HASHED_ASSETS = ['script.js', 'style.css', 'logo.png', 'favicon.png']
+CONTENT_TYPES = {
+    '.js': 'text/javascript',
+    '.css': 'text/css',
+    '.png': 'image/png',
+    '.ico': 'image/x-icon',
+    '.html': 'text/html'
+}
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'public, max-age=0, must-revalidate'
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('build')
+
+def minify(name, content):
+    if name.endswith('.js'):
+        if rjsmin is None:
+            logger.warning(f"rjsmin not installed, {name} left unminified")
+            return content
+        return rjsmin.jsmin(content.decode('utf-8')).encode('utf-8')
+    if name.endswith('.css'):
+        if rcssmin is None:
+            logger.warning(f"rcssmin not installed, {name} left unminified")
+            return content
+        return rcssmin.cssmin(content.decode('utf-8')).encode('utf-8')
+    return content
+
+def hashed_name(name, content):
+    base, ext = os.path.splitext(name)
+    return f"{base}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+def rewrite_references(text, renamed):
+    # Matches "/static/name?v=5", "/name" and the like inside quotes or url()
+    for name, new_name in renamed.items():
+        text = re.sub(
+            r'''(["'(])(?:/static)?/''' + re.escape(name) + r'''(?:\?[^"')]*)?(["')])''',
+            lambda match: f"{match.group(1)}/{new_name}{match.group(2)}",
+            text)
+    return text
+
+def headers_block(path, content_type, cache_control):
+    lines = [path]
+    if content_type:
+        lines.append(f"  Content-Type: {content_type}")
+    lines.append(f"  Cache-Control: {cache_control}")
+    return '\n'.join(lines)
+
+def build(source_dir=SOURCE_DIR, output_dir=OUTPUT_DIR):
+    """Build source_dir into output_dir with minified, fingerprinted assets.
+
+    Hashed assets get immutable caching in the generated _headers; every
+    other file, index.html included, is revalidated on each load so new
+    hashes are picked up straight away. Compression is left to Netlify,
+    which compresses responses itself.
+    """
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    renamed = {}
+    outputs = {}
+    # CSS may reference images, so hash those first
+    for name in sorted(HASHED_ASSETS, key=lambda n: n.endswith(('.js', '.css'))):
+        with open(os.path.join(source_dir, name), 'rb') as f:
+            content = f.read()
+        if name.endswith(('.js', '.css')):
+            content = rewrite_references(content.decode('utf-8'), renamed).encode('utf-8')
+        content = minify(name, content)
+        renamed[name] = hashed_name(name, content)
+        outputs[renamed[name]] = content
+
+    for name in os.listdir(source_dir):
+        if name in HASHED_ASSETS or name == '_headers':
+            continue
+        with open(os.path.join(source_dir, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.html'):
+            content = rewrite_references(content.decode('utf-8'), renamed).encode('utf-8')
+        outputs[name] = content
+
+    headers = []
+    for name, content in sorted(outputs.items()):
+        path = os.path.join(output_dir, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        cache_control = IMMUTABLE_CACHE if name in renamed.values() else REVALIDATE_CACHE
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1])
+        headers.append(headers_block(f"/{name}", content_type, cache_control))
+        if name == 'index.html':
+            headers.append(headers_block('/', content_type, cache_control))
+
+    with open(os.path.join(output_dir, '_headers'), 'w') as f:
+        f.write('\n'.join(headers) + '\n')
+
+    for name, new_name in renamed.items():
+        logger.info(f"{name} -> {new_name} ({len(outputs[new_name])} bytes)")
+    return renamed
+
+if __name__ == '__main__':
+    build(*sys.argv[1:3])
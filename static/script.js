@@ -8,8 +8,22 @@ let currentBet = null;
 let userId = (window.Telegram?.WebApp?.initDataUnsafe?.user?.id ||
               new URLSearchParams(window.location.search).get('user_id') ||
               'fallback_user_id')?.toString();
+let pendingIdempotencyKeys = {};
 
 // Global Functions
+function idempotencyKey(action) {
+    // Reuse the key until the server answers so retries replay the first result
+    if (!pendingIdempotencyKeys[action]) {
+        pendingIdempotencyKeys[action] = window.crypto?.randomUUID?.() ||
+            `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
+    return pendingIdempotencyKeys[action];
+}
+
+function settleIdempotencyKey(action) {
+    delete pendingIdempotencyKeys[action];
+}
+
 function showPage(page) {
     console.log('Showing page:', page?.id);
     document.querySelectorAll('.content').forEach(p => {
@@ -231,9 +245,13 @@ async function joinGame(betAmount) {
     try {
         const response = await fetch(`${API_URL}/join_game`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': idempotencyKey(`join_game:${betAmount}`)
+            },
             body: JSON.stringify({ user_id: userId, bet_amount: betAmount })
         });
+        if (response.status !== 409) settleIdempotencyKey(`join_game:${betAmount}`);
         const data = await response.json();
         if (data.status === 'failed') throw new Error(data.reason);
         gameId = data.game_id;
@@ -361,12 +379,19 @@ function requestWithdrawal() {
         messageDiv.textContent = '❌ መጠን ቢያንስ 100 ETB መሆን አለበት!';
         return;
     }
+    const withdrawalAction = `request_withdrawal:${amount}:${method}`;
     fetch(`${API_URL}/request_withdrawal`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': idempotencyKey(withdrawalAction)
+        },
         body: JSON.stringify({ user_id: userId, amount, method })
     })
-        .then(response => response.json())
+        .then(response => {
+            if (response.status !== 409) settleIdempotencyKey(withdrawalAction);
+            return response.json();
+        })
         .then(data => {
             messageDiv.textContent = data.status === 'requested'
                 ? `✅ ጥያቄዎ ተልኳል (ID: ${data.withdraw_id})`
@@ -568,7 +593,11 @@ document.addEventListener('DOMContentLoaded', function() {
             try {
                 const response = await fetch(`${API_URL}/check_bingo`, {
                     method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
+                    headers: {
+                        'Content-Type': 'application/json',
+                        // One bingo claim per game, so every retry shares the key
+                        'Idempotency-Key': `check_bingo:${gameId}`
+                    },
                     body: JSON.stringify({ user_id: userId, game_id: gameId })
                 });
                 const data = await response.json();
@@ -675,6 +704,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 contentDiv.innerHTML = `
                     <h2>👥 ጓደኞችን ጋብዝ</h2>
                     <p>ሪፈራል ሊንክ: <a href="${data.referral_link}" target="_blank">${data.referral_link}</a></p>
+                    <p>የሪፈራል ኮድ: <b>${data.referral_code}</b></p>
                     <p>የጋበዙት ጓደኞች: ${data.referral_count}</p>
                     <p>20 ጓደኞችን በመጋበዝ 10 ETB ያግኙ!</p>
                 `;